@@ -1,83 +1,233 @@
+import math
 import os
 from pathlib import Path
+import pickle
 import random
+import warnings
 import numpy as np
-from PIL import Image, ImageOps
+from PIL import Image
 import torch
+from torch._dynamo.exc import BackendCompilerFailed
+from torch._inductor import exc as inductor_exc
 from torch.nn import functional as F
-from torchvision.transforms import functional as TVF
-from torchvision.transforms import InterpolationMode
 from torch.utils.data import Dataset, DataLoader
 from torchvision import transforms
+from torchvision.io import ImageReadMode, decode_image, read_file
 
 from beit import settings
 
-def scale(image, label):
-    usable_scale_values = image.size()[-2:]
-    ratio = np.random.choice(settings.SCALE_VALUES)
-    image = F.interpolate(image, scale_factor=ratio, mode='bilinear', align_corners=True)
-    label = F.interpolate(label, scale_factor=ratio, mode='nearest')
-    return image, label
-
 def crop(image, label=None):
     # TODO: fix crop sizes being too small
     h, w = image.size()[-2:]
     crop_size = settings.CROP_SIZE
-    s_h = np.random.randint(0, h - crop_size + 1) if h > crop_size else 0
-    s_w = np.random.randint(0, w - crop_size + 1) if w > crop_size else 0
+    # Draw from torch's RNG in one call; unlike NumPy's, the DataLoader seeds it differently in each worker
+    r_h, r_w = torch.rand(2).tolist()
+    s_h = int(r_h * (h - crop_size + 1)) if h > crop_size else 0
+    s_w = int(r_w * (w - crop_size + 1)) if w > crop_size else 0
     e_h = min(s_h + crop_size, h)
     e_w = min(s_w + crop_size, w)
     image = image[:, :, s_h: e_h, s_w: e_w]
     label = label[:, :, s_h: e_h, s_w: e_w]
     return image, label
 
-def flip(image, label=None):
-    if np.random.rand() < 0.5:
-        image = torch.flip(image, [3])
-        if label is not None:
-            label = torch.flip(label, [3])
-    return image, label
-
-def adjust_brightness(image, label=None):
-    brightness = np.random.uniform(0.7, 1.2)
-    contrast = np.random.uniform(0.8, 1.2)
-    image = transforms.functional.adjust_brightness(image, brightness)
-    image = transforms.functional.adjust_contrast(image, contrast)
-    return image, label
-
-def rotate(image, label=None):
-    angle = np.random.uniform(-20, 20)
-    image = transforms.functional.rotate(image, angle)
-    label = transforms.functional.rotate(label, angle, fill=255)
-    return image, label
-
-def _pad_and_resize(image, pad_value, interpolation_mode):
-    w, h = image.size()[-2:]
-    max_wh = np.max([w, h])
-    hp = int((max_wh - w) / 2)
-    vp = int((max_wh - h) / 2)
-    padding = (hp, vp, hp, vp)
-    image = TVF.pad(image, padding, pad_value, 'constant')
-    image = TVF.resize(image, settings.MODEL_INPUT_DIM, interpolation_mode)
-    image = TVF.center_crop(image, settings.MODEL_INPUT_DIM)
-    return image
+def _pad_and_resize(image, out, mode):
+    """
+    Resizes a 4D image into a preallocated square output while maintaining its aspect ratio. Only
+    the image itself is resampled and written, so the output's existing contents act as the padding
+    """
+    h, w = image.size()[-2:]
+    max_wh = w if w > h else h
+    dim = out.size(-1)
+    new_h = round(h * dim / max_wh)
+    new_w = round(w * dim / max_wh)
+    vp = (dim - new_h) // 2
+    hp = (dim - new_w) // 2
+    if (new_h, new_w) == (h, w):
+        resized = image
+    elif mode == 'nearest':
+        # Gather the source rows and columns directly, which keeps integer labels out of the float interpolation path
+        rows = torch.arange(new_h, device=image.device) * h // new_h
+        cols = torch.arange(new_w, device=image.device) * w // new_w
+        resized = image[..., rows[:, None], cols[None, :]]
+    else:
+        resized = F.interpolate(image, size=(new_h, new_w), mode=mode, align_corners=False, antialias=True)
+    out[..., vp: vp + new_h, hp: hp + new_w] = resized
 
 def resize(images: tuple[torch.Tensor], labels=None):
     """ Resizes an image to the BEit input size while maintaining its aspect ratio """
-    images = torch.stack([_pad_and_resize(image, 0, InterpolationMode.BICUBIC) for image in images]).cuda()
+    # Allocate each output batch once, already filled with the padding value, and resample into it
+    # Images are laid out channels-last to match the model's convolutions
+    size = (len(images), settings.MODEL_INPUT_DIM, settings.MODEL_INPUT_DIM)
+    resized_images = torch.empty(
+        (size[0], images[0].size(0), *size[1:]),
+        device='cuda',
+        memory_format=torch.channels_last,
+    ).zero_()
+    for i, image in enumerate(images):
+        # Copy the variable-sized uint8 tensors over first so conversion and resampling run on the GPU
+        image = image.cuda(non_blocking=True).float().mul_(1 / 255)
+        # TODO: normalize with mean and stdev
+        # image = (image - settings.MEAN) / settings.STD
+        _pad_and_resize(image.unsqueeze(0), resized_images[i: i + 1], 'bicubic')
     if labels:
-        labels = torch.squeeze(torch.stack([_pad_and_resize(torch.unsqueeze(label, 0), 0, InterpolationMode.NEAREST) for label in labels]), 1).cuda()
-        return images, labels
-    return images
+        # Labels stay uint8 until they're on the GPU and through resizing
+        resized_labels = torch.zeros(size, dtype=torch.uint8, device='cuda')
+        for i, label in enumerate(labels):
+            _pad_and_resize(label.cuda(non_blocking=True)[None, None], resized_labels[i: i + 1, None], 'nearest')
+        return resized_images, resized_labels.to(torch.int64)
+    return resized_images
+
+def prefetch(batches):
+    """
+    Yields resized (images, labels, filenames) batches, copying and resizing each batch on a side CUDA
+    stream while the caller is still working on the previous one
+    """
+    stream = torch.cuda.Stream()
+    pending = None
+    for images, labels, filenames in batches:
+        with torch.cuda.stream(stream):
+            images, labels = resize(images, labels)
+            ready = stream.record_event()
+        if pending is not None:
+            yield _wait_for(*pending)
+        pending = (images, labels, filenames, ready)
+    if pending is not None:
+        yield _wait_for(*pending)
+
+def _wait_for(images, labels, filenames, ready):
+    """ Makes the current stream wait for a prefetched batch and take ownership of its memory """
+    current_stream = torch.cuda.current_stream()
+    current_stream.wait_event(ready)
+    images.record_stream(current_stream)
+    labels.record_stream(current_stream)
+    return images, labels, filenames
+
+def _augment_batch(images, labels, params):
+    """ Applies the augmentations described by a (batch_size, 5) tensor of uniform random parameters """
+    scale_values = torch.tensor(settings.SCALE_VALUES, device=images.device)
+    # Scaling zooms about the centre of the already-square batch, so ratios below 1 would shrink the content and
+    # fill most of the sample with padding and ignored labels (75% at 0.5). Those draws leave the scale unchanged,
+    # matching the original pipeline where resize() undid the rescaling of a full-size crop
+    ratios = scale_values[(params[:, 0] * len(settings.SCALE_VALUES)).long()].clamp(min=1)
+    flip_signs = torch.where(params[:, 1] < 0.5, -1., 1.)
+    angles = torch.deg2rad(params[:, 2] * 40 - 20)
+    brightness = (params[:, 3] * 0.5 + 0.7).view(-1, 1, 1, 1)
+    contrast = (params[:, 4] * 0.4 + 0.8).view(-1, 1, 1, 1)
+
+    # Brightness (x * b) and contrast ((x - mean) * c + mean) folded into a single multiply-add. This runs before
+    # the warp, as it did before rotation originally, so the fill added by the warp stays black and out of the mean
+    mean = transforms.functional.rgb_to_grayscale(images).mean(dim=(-3, -2, -1), keepdim=True)
+    images = (images * (brightness * contrast) + mean * (brightness * (1 - contrast))).clamp(0, 1)
+
+    # theta maps normalized output coordinates back to the input; batches are square after resize()
+    # so rotations need no aspect ratio correction
+    cos, sin = angles.cos() / ratios, angles.sin() / ratios
+    zeros = torch.zeros_like(cos)
+    theta = torch.stack([
+        torch.stack([flip_signs * cos, -flip_signs * sin, zeros], dim=-1),
+        torch.stack([sin, cos, zeros], dim=-1),
+    ], dim=1)
+    grid = F.affine_grid(theta, images.size(), align_corners=False)
+    images = F.grid_sample(images, grid, mode='bilinear', align_corners=False)
+    labels = F.grid_sample(labels.unsqueeze(1).float(), grid, mode='nearest', align_corners=False).squeeze(1)
+    # Pixels moved in from outside the original label are ignored
+    labels = torch.where((grid.abs() > 1).any(dim=-1), settings.IGNORE_INDEX, labels)
+    return images, labels.to(torch.int64)
+
+# Chosen on the first call to augment(); resize() isn't compiled since every image it receives has a different shape
+_augment_batch_fn = None
+# Newer versions raise Inductor failures directly instead of wrapping them in BackendCompilerFailed
+_COMPILE_FAILURES = (BackendCompilerFailed, getattr(inductor_exc, 'InductorError', BackendCompilerFailed))
+
+def _run_augment_batch(images, labels, params):
+    """ Runs the compiled augmentations, falling back to eager mode if torch.compile isn't supported here """
+    global _augment_batch_fn
+    if _augment_batch_fn is None:
+        if not settings.COMPILE_AUGMENTATIONS:
+            _augment_batch_fn = _augment_batch
+            return _augment_batch_fn(images, labels, params)
+        try:
+            # Raised straight away on platforms without torch.compile support, e.g. Windows before torch 2.4
+            compiled = torch.compile(_augment_batch)
+        except RuntimeError as e:
+            warnings.warn(f'torch.compile is unsupported here, running augmentations eagerly: {e}')
+            _augment_batch_fn = _augment_batch
+            return _augment_batch_fn(images, labels, params)
+        try:
+            # Compilation happens on the first call, which fails if the backend is unusable (e.g. no Triton).
+            # Any other error propagates and compilation is retried on the next call
+            result = compiled(images, labels, params)
+        except _COMPILE_FAILURES as e:
+            warnings.warn(f'Could not compile augmentations, running them eagerly: {e}')
+            _augment_batch_fn = _augment_batch
+            return _augment_batch_fn(images, labels, params)
+        _augment_batch_fn = compiled
+        return result
+    return _augment_batch_fn(images, labels, params)
+
+def augment(images, labels):
+    """
+    Randomly scales, flips, rotates and adjusts the brightness/contrast of a
+    resized batch on its current device, with one resampling step for the whole batch
+    """
+    # Draw every sample's parameters with a single RNG call
+    params = torch.rand((images.size(0), 5), device=images.device)
+    images, labels = _run_augment_batch(images, labels, params)
+    # grid_sample returns NCHW regardless of its input, so restore the model's channels-last layout
+    return images.contiguous(memory_format=torch.channels_last), labels
+
+def _decode_image(path):
+    """ Decodes with libjpeg-turbo/libpng straight into a CHW uint8 array instead of going through PIL """
+    return decode_image(read_file(str(path)), mode=ImageReadMode.RGB, apply_exif_orientation=True).numpy()
+
+def _decode_label(path):
+    with Image.open(path).convert('P') as label:
+        # Dataset uses black and white and has no masked out pixels, convert 255 values to the correct class index
+        return (np.asarray(label) == 255).astype(np.uint8)
+
+def _write_atomically(path: Path, save):
+    """ Saves to a temporary file and renames it into place, so an interrupted run never leaves a truncated file """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f'.tmp{path.suffix}')
+    save(tmp_path)
+    os.replace(tmp_path, path)
+
+def _load_cached(cache_path: Path, decode, path: Path):
+    """
+    Loads a decoded uint8 array from the on-disk cache, decoding and caching it first if it's missing.
+    Cached arrays are memory-mapped, so they're shared through the page cache between workers and epochs
+    """
+    if not cache_path.exists():
+        _write_atomically(cache_path, lambda tmp_path: np.save(tmp_path, decode(path)))
+    return torch.from_numpy(np.load(cache_path, mmap_mode='c'))
+
+def _load_split():
+    """
+    Returns the (training, validation) image paths, scanning and shuffling the dataset folder only the
+    first time. Delete the cached split if images are added to or removed from the dataset
+    """
+    split_path = settings.CACHE_FOLDER / f'split_{settings.TRAIN_DATA_RATIO}.pkl'
+    if split_path.exists():
+        with open(split_path, 'rb') as f:
+            return pickle.load(f)
+
+    # Sort so the split doesn't depend on the filesystem's iteration order
+    image_paths = sorted((settings.DATASET_FOLDER / 'image').iterdir())
+    random.Random(0).shuffle(image_paths)
+    num_training_images = round(len(image_paths) * settings.TRAIN_DATA_RATIO)
+    split = image_paths[:num_training_images], image_paths[num_training_images:]
+    split_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(split_path, 'wb') as f:
+        pickle.dump(split, f)
+    return split
 
 """ Dataset classes """
 # TODO: make sure during validation, images are squished to 224x224 and that during training images with improper aspect ratios are used
 class BlurDetectionDataset(Dataset):
-    def __init__(self):
-        image_folder = settings.DATASET_FOLDER / 'image'
+    def __init__(self, image_paths):
         label_folder = settings.DATASET_FOLDER / 'gt'
-        self.image_paths = [image_folder / filename for filename in image_folder.iterdir()]
-        self.label_paths = [label_folder / f'{filename.stem}.png' for filename in image_folder.iterdir()]
+        self.image_paths = image_paths
+        self.label_paths = [label_folder / f'{path.stem}.png' for path in image_paths]
 
     def __len__(self):
         return len(self.image_paths)
@@ -89,73 +239,118 @@ class BlurDetectionDataset(Dataset):
         # Since images don't always have the same file extension, determine what it is programatically
         image_path = self.image_paths[idx]
         label_path = self.label_paths[idx]
-        with Image.open(image_path).convert('RGB') as image:
-            image = np.array(ImageOps.exif_transpose(image))
-            image = torch.FloatTensor(image) / 255
-            # TODO: normalize with mean and stdev
-            # image = (image - settings.MEAN) / settings.STD
-            image = image.permute(2, 0, 1).unsqueeze(dim=0)
-
-        with Image.open(label_path).convert('P') as label:
-            label = torch.FloatTensor(np.array(label))
-            label = label.unsqueeze(dim=0).unsqueeze(dim=1)
-            # Dataset uses black and white and has no masked out pixels, convert 255 values to the correct class index
-            label[label == 255] = 1
-
-        # Change tensors to correct dimensionality and type
-        return image, label.to(torch.uint8)
+        # Conversion to float is deferred until resize() has copied the image to the GPU
+        image = _load_cached(settings.CACHE_FOLDER / 'image' / f'{image_path.stem}.npy', _decode_image, image_path)
+        image = image.unsqueeze(dim=0)
+
+        # Cached labels already hold class indices, so only the cropped region of the mask is read
+        label = _load_cached(settings.CACHE_FOLDER / 'label' / f'{label_path.stem}.npy', _decode_label, label_path)
+        label = label.unsqueeze(dim=0).unsqueeze(dim=1)
+
+        return image, label
 
 class TrainingBlurDetectionDataset(BlurDetectionDataset):
     def __init__(self):
-        super().__init__()
-        paths = list(zip(self.image_paths, self.label_paths))
-        random.seed(0)
-        random.shuffle(paths)
-        self.image_paths, self.label_paths = zip(*paths)
-        self.image_paths = self.image_paths[:round(len(paths) * settings.TRAIN_DATA_RATIO)]
-        self.label_paths = self.label_paths[:round(len(paths) * settings.TRAIN_DATA_RATIO)]
+        super().__init__(_load_split()[0])
 
     def __getitem__(self, idx: int):
         image, label = self._fetch(idx)
 
-        # Perform augmentation
+        # Crop here to shrink the transfer; the remaining augmentations resample the image and are
+        # applied to the whole batch on the GPU by augment(). The crops are cloned since sending a view
+        # back from a worker would share its entire storage, i.e. the full-resolution cached array
         image, label = crop(image, label)
-        image, label = scale(image, label)
-        image, label = flip(image, label)
-        image, label = adjust_brightness(image, label)
-        image, label = rotate(image, label)
 
-        return image.squeeze(dim=0), label.squeeze().to(torch.int64), self.image_paths[idx].name
+        return image.squeeze(dim=0).clone(), label.squeeze().clone(), self.image_paths[idx].name
 
 class ValidationBlurDetectionDataset(BlurDetectionDataset):
+    """
+    Validation samples never change, so they're resized once and cached together as uint8 tensors.
+    Each process memory-maps the cache on first access instead of decoding and resizing every pass
+    """
     def __init__(self):
-        super().__init__()
-        paths = list(zip(self.image_paths, self.label_paths))
-        random.seed(0)
-        random.shuffle(paths)
-        self.image_paths, self.label_paths = zip(*paths)
-        self.image_paths = self.image_paths[round(len(paths) * settings.TRAIN_DATA_RATIO):]
-        self.label_paths = self.label_paths[round(len(paths) * settings.TRAIN_DATA_RATIO):]
-
+        super().__init__(_load_split()[1])
+        self.cache_path = settings.CACHE_FOLDER / f'validation_{settings.TRAIN_DATA_RATIO}_{settings.MODEL_INPUT_DIM}.pt'
+        self._samples = None
+        if not self._is_cache_current():
+            self._cache_resized()
 
     def __getitem__(self, idx: int):
-        image, label = self._fetch(idx)
+        if self._samples is None:
+            self._samples = torch.load(self.cache_path, mmap=True)
+        return self._samples['images'][idx], self._samples['labels'][idx], self.image_paths[idx].name
+
+    def _is_cache_current(self):
+        """ Checks the cache was built from this split, since the split is rebuilt if its own cache is deleted """
+        if not self.cache_path.exists():
+            return False
+        return torch.load(self.cache_path, mmap=True).get('filenames') == [path.name for path in self.image_paths]
 
-        return image.squeeze(dim=0), label.squeeze().to(torch.int64), self.image_paths[idx].name
+    def _cache_resized(self):
+        resized_images, resized_labels = [], []
+        for start in range(0, len(self), settings.BATCH_SIZE):
+            # Decode directly rather than through _fetch, since the full-resolution per-file cache would never be read again
+            indices = range(start, min(start + settings.BATCH_SIZE, len(self)))
+            images = [torch.from_numpy(_decode_image(self.image_paths[idx])) for idx in indices]
+            labels = [torch.from_numpy(_decode_label(self.label_paths[idx])) for idx in indices]
+            images, labels = resize(images, labels)
+            resized_images.append(images.mul(255).round_().clamp_(0, 255).to(torch.uint8).cpu())
+            resized_labels.append(labels.to(torch.uint8).cpu())
+        samples = dict(
+            images=torch.cat(resized_images).contiguous(),
+            labels=torch.cat(resized_labels),
+            filenames=[path.name for path in self.image_paths],
+        )
+        _write_atomically(self.cache_path, lambda tmp_path: torch.save(samples, tmp_path))
 
 def _collate_fn(batch):
     """
-    Collate function for dataloader to keep batches as List[torch.Tensor]
-    instead of merging into a single tensor
+    Groups samples into (images, labels, filenames) tuples, keeping the variable-sized
+    images and labels as separate tensors instead of merging them into a single tensor
     """
     images, labels, filenames = zip(*batch)
     return images, labels, filenames
 
+class _BatchingLoader:
+    """
+    Groups the single samples yielded by a DataLoader into batches. Workers are handed
+    samples round-robin rather than whole batches, so a batch is ready after each worker
+    loads ceil(batch_size / num_workers) samples instead of one worker loading all of them
+    """
+    def __init__(self, sample_loader, batch_size):
+        self.sample_loader = sample_loader
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return math.ceil(len(self.sample_loader) / self.batch_size)
+
+    def __iter__(self):
+        batch = []
+        for sample in self.sample_loader:
+            batch.append(sample)
+            if len(batch) == self.batch_size:
+                yield _collate_fn(batch)
+                batch = []
+        if batch:
+            yield _collate_fn(batch)
+
 def create_dataloader(dataset):
-    return DataLoader(
+    num_workers = settings.NUM_WORKERS
+    if isinstance(dataset, ValidationBlurDetectionDataset):
+        # Validation samples only index a memory-mapped cache, so worker processes would just sit idle
+        num_workers = 0
+    elif num_workers is None:
+        # Capped since very large worker counts can freeze the loader
+        num_workers = min(max(1, (os.cpu_count() or 2) // 2), 16)
+    # Automatic batching is disabled so each index is dispatched to the next worker on its own.
+    # Prefetching is counted in samples, so scale it to keep the same number of batches in flight
+    sample_loader = DataLoader(
         dataset,
-        batch_size=settings.BATCH_SIZE,
-        num_workers=settings.NUM_WORKERS,
+        batch_size=None,
+        num_workers=num_workers,
         shuffle=isinstance(dataset, TrainingBlurDetectionDataset),
-        collate_fn=_collate_fn,
+        pin_memory=True,
+        persistent_workers=num_workers > 0,
+        prefetch_factor=settings.PREFETCH_FACTOR * settings.BATCH_SIZE if num_workers > 0 else None,
     )
+    return _BatchingLoader(sample_loader, settings.BATCH_SIZE)
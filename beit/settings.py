@@ -3,10 +3,12 @@ from pathlib import Path
 
 # Paths
 DATASET_FOLDER = Path('a:/', 'Datasets', 'blurdetection')
+CACHE_FOLDER = DATASET_FOLDER / 'cache'
 
 # Configuration
 MODEL_NAME = 'blur975'
-NUM_WORKERS = 4
+NUM_WORKERS = None # Chosen from the CPU count when None
+PREFETCH_FACTOR = 2 # Batches' worth of samples loaded in advance per worker, kept low since prefetched samples are pinned
 BATCH_SIZE = 16
 BATCHES_PER_UPDATE = 4
 MAX_ITER = 1_200
@@ -16,6 +18,7 @@ LOG_EVERY = 10
 VALIDATE_EVERY = 50
 TRAIN_DATA_RATIO = 0.975
 VISUALIZE_DURING_TESTING = True
+COMPILE_AUGMENTATIONS = True # Falls back to eager mode where torch.compile isn't supported (e.g. Windows without Triton)
 
 # Static values (should require no configuration)
 CROP_SIZE = 224
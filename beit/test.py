@@ -5,7 +5,7 @@ from torch.nn import functional as F
 import sys
 from pathlib import Path
 sys.path.append(str(Path(__file__).resolve().parent.parent))
-from dataset import ValidationBlurDetectionDataset, create_dataloader, resize
+from dataset import ValidationBlurDetectionDataset, create_dataloader, prefetch
 from beit import settings
 from utils import load_model, upscale, visualize
 
@@ -20,9 +20,8 @@ def validate(model, dataset, do_visualize=False):
         total_loss = 0
         total_iou = 0
         num_batches = 0
-        for batch in dataset:
+        for batch in prefetch(dataset):
             images, labels, filenames = batch
-            images, labels = resize(images, labels)
             preds = model(pixel_values=images, labels=labels)
             total_loss += preds.loss
             pred_labels = upscale(preds.logits)
@@ -7,11 +7,16 @@ from transformers import (
 import sys
 from pathlib import Path
 sys.path.append(str(Path(__file__).resolve().parent.parent))
-from dataset import TrainingBlurDetectionDataset, ValidationBlurDetectionDataset, create_dataloader, resize
+from dataset import TrainingBlurDetectionDataset, ValidationBlurDetectionDataset, augment, create_dataloader, prefetch
 from beit import settings
 from test import validate
 from utils import load_model, save, visualize
 
+def _batches(dataloader):
+    """ Yields batches indefinitely, reusing each epoch's iterator instead of restarting the workers' queues """
+    while True:
+        yield from dataloader
+
 # TODO: add logging code
 def train():
     # Use pre-trained BEiT model to fine-tune
@@ -22,13 +27,14 @@ def train():
     test_dataset = create_dataloader(ValidationBlurDetectionDataset())
 
     # Training loop
+    train_batches = prefetch(_batches(train_dataset))
     model.train()
     total_loss = 0
     # Resume running iterations from where the previous model left off (or from the beginning)
     for iteration in range(iteration + 1, settings.MAX_ITER + 1):
         for _ in range(settings.BATCHES_PER_UPDATE):
-            images, labels, filename = next(iter(train_dataset))
-            images, labels = resize(images, labels)
+            images, labels, filename = next(train_batches)
+            images, labels = augment(images, labels)
 
             # Predict
             preds = model(pixel_values=images, labels=labels)
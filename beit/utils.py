@@ -92,7 +92,7 @@ def load_model(mode: ['train', 'eval']):
         semantic_loss_ignore_index=settings.IGNORE_INDEX,
     )
     model = BeitForSemanticSegmentation(config)
-    model.to(torch.device('cuda'))
+    model.to(torch.device('cuda'), memory_format=torch.channels_last)
     optimizer = torch.optim.AdamW(model.parameters(), lr=settings.INITIAL_LEARNING_RATE)
     lr_scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=settings.MAX_ITER)
     iteration = 0
@@ -116,7 +116,7 @@ def load_model(mode: ['train', 'eval']):
             'microsoft/beit-base-patch16-224-pt22k',
             config=config,
         )
-        model.to(torch.device('cuda'))
+        model.to(torch.device('cuda'), memory_format=torch.channels_last)
         optimizer = torch.optim.AdamW(model.parameters(), lr=settings.INITIAL_LEARNING_RATE)
         lr_scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=settings.MAX_ITER)
 